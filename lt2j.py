@@ -3,14 +3,21 @@
 # Standard modules
 import argparse
 import json
+import logging
 import os.path
+import shelve
 import sys
-# Not so standard modules
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import astuple, dataclass
+from datetime import datetime, timedelta
+from operator import itemgetter
 
-import pyexcel as pyex
-from jira import JIRA
-from tzlocal import get_localzone
+# The not so standard modules are slow to load, so they are only imported
+# where they are needed, once the command-line arguments have been checked.
+
+log = logging.getLogger("lt2j")
 
 # Built-in configuration {{{
 #
@@ -24,165 +31,484 @@ fmap = {
   "description": 5,
 }
 
-# }}}
-# Parse the command-line arguments {{{
-#
-# Create a parser, add all the available arguments to it
-parser = argparse.ArgumentParser(prog="lt2j", description="Read a spreadsheet containing worklog entries, and add them to Jira.")
-parser.add_argument("-d", "--debug", action="store_true", help="Run in debug mode.")
-parser.add_argument("-y", "--yolo", "--yes", action="store_true", help="Yes, really do create worklog entries in jira.")
-parser.add_argument("-f", "--file", required=True, help="Path to the file with the spreadsheet")
-parser.add_argument("-n", "--sheet", required=True, help="Name of the sheet (tab) where worklog entries are stored.")
-parser.add_argument("-s", "--start", type=int, default=1, help="Start importing frow this row number.")
-parser.add_argument("-e", "--end", type=int, default=0, help="End importing at this row number.")
-parser.add_argument("-u", "--jira-url", required=True, help="The URL where Jira is hosted at.",)
-parser.add_argument("-t", "--jira-token", required=True, help="The private token for Jira")
-parser.add_argument("command", choices=["create", "remove"], default="create", help="Create or remove worklogs from Jira")
-args = parser.parse_args()
+# How many fields a row needs to have, and how to pick them all out of it
+fields = max(fmap.values()) + 1
+extract = itemgetter(fmap["date"], fmap["time_from"], fmap["time_to"], fmap["duration"], fmap["issue_id"], fmap["description"])
+
+# How many requests to send to Jira at the same time, unless told otherwise
+concurrency = 16
+
+# How many times to try a request to Jira before giving up, and the longest
+# time in seconds to wait between two tries
+retry_attempts = 5
+retry_max_wait = 30
+
+# Statuses on which Jira did not process the request, so that any request can
+# be tried again, and statuses on which it may or may not have been processed,
+# so that only requests which are safe to repeat are tried again
+retry_statuses_rejected = (429, 503)
+retry_statuses_unknown = (500, 502, 504)
+
+# How many rows to process before the output is written to the terminal
+output_batch = 64
+
+# How many worklogs Jira returns at most for a single bulk request
+worklog_list_limit = 1000
+
+# Where worklogs fetched from Jira are cached between runs, and for how many
+# seconds a cached entry stays valid
+cache_file = os.path.expanduser("~/.cache/lt2j/worklogs-v2.db")
+cache_ttl = 300
 
 # }}}
-# Do some sanity checking{{{
+# Helper functions {{{
 #
-# Check for common errors in the configuration that we've got
-if not args.yolo:
-  print("The yolo mode is *NOT* on! Not doing anything, just reporting what would have been done.")
+# Indented JSON for debug output. It is only rendered when the debug message
+# is actually logged.
+class DebugJSON:
+  __slots__ = ("obj",)
+
+  def __init__(self, obj):
+    self.obj = obj
+
+  def __str__(self):
+    import orjson
+    return orjson.dumps(self.obj, option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode()
+
+# Read the rows of a sheet, one at a time. XLSX files are streamed with
+# openpyxl directly, all other formats are read through pyexcel. Rows are
+# numbered from 1, end is the last row to read, or 0 to read all rows. Rows
+# without any values are skipped.
+def read_rows(file_name, sheet_name, start, end):
+  for row in read_sheet(file_name, sheet_name, start, end):
+    if any(value != "" for value in row):
+      yield row
+
+# Read all rows of a sheet for read_rows(), with empty cells as ""
+def read_sheet(file_name, sheet_name, start, end):
+  if file_name.lower().endswith(".xlsx"):
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_name, read_only = True, data_only = True)
+    try:
+      # Empty cells are None, turn them into "" like pyexcel does
+      for row in workbook[sheet_name].iter_rows(min_row = start, max_row = end or None, values_only = True):
+        yield ["" if value is None else value for value in row]
+    finally:
+      workbook.close()
+  else:
+    import pyexcel as pyex
+    try:
+      yield from pyex.iget_array(
+        file_name = file_name,
+        sheet_name = sheet_name,
+        start_row = start - 1,
+        row_limit = end - start + 1 if end else 0,
+        keep_trailing_empty_cells = True,
+      )
+    finally:
+      pyex.free_resources()
+
+# A worklog, as described by a row in the spreadsheet
+@dataclass(slots=True)
+class Entry:
+  issue_id: str
+  started_dt: datetime
+  duration_sec: int
+  description: str
+
+# Check a row from the spreadsheet for sanity, and turn it into an Entry.
+# Returns None if the row can not be used.
+def parse_row(row, local_tz):
+  log.debug("Processing row: %s", row)
+  if len(row) < fields:
+    print(f"Warning: Row {row} has {len(row)} fields, but we require at least {fields}, skipping this row.")
+    return None
+  date, time_from, time_to, duration, issue_id, description = extract(row)
+  log.debug("parsed from row: date=%s, time_from=%s, time_to=%s, duration=%s, issue_id=%s, description=%s", date, time_from, time_to, duration, issue_id, description)
+
+  # Calculate dates and times
+  try:
+    started_dt = datetime(date.year, date.month, date.day, time_from.hour, time_from.minute, time_from.second, tzinfo = local_tz)
+    if isinstance(duration, timedelta):
+      duration_sec = int(duration.total_seconds())
+    else:
+      duration_sec = duration.second + duration.minute * 60 + duration.hour * 3600
+  except (AttributeError, TypeError, ValueError) as e:
+    print(f"Warning: Row {row} does not hold a valid date, time and duration, skipping this row: {e}")
+    return None
+  log.debug("calculated dates and durations: started_dt=%s, duration_sec=%d", started_dt, duration_sec)
+  return Entry(issue_id, started_dt, duration_sec, description)
+
+# A worklog from Jira, with only the fields that are needed to match it
+@dataclass(slots=True, frozen=True)
+class Worklog:
+  id: str
+  issue_id: str
+  author_key: str
+  started_dt: datetime
+  duration_sec: int
+
+# Turn the raw data of a worklog from Jira into a Worklog
+def to_worklog(raw):
+  log.debug("This is worklog %s for issue %s: %s", raw["id"], raw["issueId"], DebugJSON(raw))
+  return Worklog(raw["id"], raw["issueId"], raw.get("author", {}).get("key"), datetime.fromisoformat(raw["started"]), int(raw["timeSpentSeconds"]))
+
+# Is the error from Jira a transient one, that is worth trying again? Requests
+# that Jira rejected are always worth it. Requests that may have been
+# processed, because the server failed or the connection broke, only are if
+# they are idempotent.
+def is_transient(e, idempotent):
+  from jira import JIRAError
+  from requests.exceptions import ConnectionError
+  if isinstance(e, JIRAError):
+    return e.status_code in retry_statuses_rejected or (idempotent and e.status_code in retry_statuses_unknown)
+  return idempotent and isinstance(e, ConnectionError)
+
+# Call fn, and try again if it fails with a transient error. Waits between
+# tries with exponential backoff and jitter, but at least as long as Jira
+# asked us to in the Retry-After header. This is the only place where
+# requests are retried, the JIRA client itself is set up not to retry.
+def retry_transient(fn, *args, idempotent = True, **kwargs):
+  from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+  backoff = wait_exponential_jitter(initial=1, max=retry_max_wait)
+  def wait_for_retry(retry_state):
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit():
+      return max(int(retry_after), backoff(retry_state))
+    return backoff(retry_state)
+
+  retrying = Retrying(
+    retry = retry_if_exception(lambda e: is_transient(e, idempotent)),
+    stop = stop_after_attempt(retry_attempts),
+    wait = wait_for_retry,
+    reraise = True,
+  )
+  return retrying(fn, *args, **kwargs)
+
+# Add a single worklog. Adding is not idempotent, a repeated request after
+# Jira already saved the worklog would add it twice.
+def add_worklog(jira, issue_id, started_dt, duration_sec, description):
+  retry_transient(jira.add_worklog, issue = issue_id, started = started_dt, timeSpentSeconds = duration_sec, comment = description, idempotent = False)
+
+# Add worklogs for a single issue, one after another. Jira aggregates the
+# timeSpent of an issue on every worklog that is added, and parallel posts to
+# the same issue can race and leave a wrong total, so worklogs for one issue
+# must never be added concurrently. Returns the number of worklogs that could
+# not be added.
+def add_worklogs(jira, issue_id, chain):
+  failed = 0
+  for started_dt, duration_sec, description in chain:
+    print(f"Adding worklog (started_dt={started_dt}, duration_sec=@{duration_sec}, description={description[:36]!r}) for issue (issue_id={issue_id})", flush=True)
+    try:
+      add_worklog(jira, issue_id, started_dt, duration_sec, description)
+    except Exception as e:
+      print(f"ERROR: Failed to add worklog (started_dt={started_dt}, duration_sec=@{duration_sec}) for issue (issue_id={issue_id}): {e}", flush=True)
+      failed += 1
+  return failed
+
+# Retrieve the given worklogs in bulk, as a list of Worklogs. If issue_ids is
+# given, only worklogs on issues with these numeric ids are kept. Raises
+# JIRAError if the server does not know the bulk endpoint.
+def list_worklogs(jira, worklog_ids, issue_ids = None):
+  worklogs = []
+  for i in range(0, len(worklog_ids), worklog_list_limit):
+    r = retry_transient(jira._session.post, jira._get_url("worklog/list"), data = json.dumps({"ids": worklog_ids[i:i + worklog_list_limit]}))
+    worklogs.extend(to_worklog(raw) for raw in r.json() if issue_ids is None or raw["issueId"] in issue_ids)
+  return worklogs
+
+# Retrieve all worklogs for an issue, as a list of Worklogs. Worklogs are
+# taken from the cache if they were fetched recently enough, otherwise they
+# are fetched from Jira and written to the cache. The cache holds plain
+# tuples, so that it does not depend on where the Worklog class lives.
+def load_worklogs(jira, cache, issue_id):
+  key = f"{jira.server_url}|{issue_id}"
+  if cache is not None:
+    entry = cache.get(key)
+    if entry is not None and time.time() - entry["fetched_at"] < cache_ttl:
+      return [Worklog(*fields) for fields in entry["worklogs"]]
+  worklogs = [to_worklog(worklog.raw) for worklog in retry_transient(jira.worklogs, issue_id)]
+  if cache is not None:
+    cache[key] = {"fetched_at": time.time(), "worklogs": [astuple(worklog) for worklog in worklogs]}
+  return worklogs
+
+# Forget the cached worklogs for an issue, once we have changed them
+def invalidate_worklogs(jira, cache, issue_id):
+  if cache is not None:
+    cache.pop(f"{jira.server_url}|{issue_id}", None)
+
+# Add a worklog of an issue to the index if it was authored by author_key
+def add_to_index(index, issue_id, worklog, author_key):
+  if worklog.author_key == author_key:
+    index.setdefault((issue_id, worklog.started_dt, worklog.duration_sec), []).append(worklog.id)
+
+# Load the worklogs for an issue, and add the ones that were authored by
+# author_key to the index, as lists of worklog_ids keyed by (issue_id,
+# started_dt, duration_sec)
+def index_worklogs(jira, cache, issue_id, author_key, index):
+  # Show everything so far before waiting for jira, and the result after it
+  sys.stdout.flush()
+  worklogs = load_worklogs(jira, cache, issue_id)
+  print(f"Loaded worklogs for issue (issue_id={issue_id}): {'.' * len(worklogs)}", flush=True)
+  log.debug("These are all worklogs for issue_id=%s: %s", issue_id, [worklog.id for worklog in worklogs])
+  for worklog in worklogs:
+    add_to_index(index, issue_id, worklog, author_key)
+
+# Find the worklogs that were authored by author_key on the given issues, and
+# add them to the index like index_worklogs() does. Instead of loading all
+# worklogs of every issue, only worklogs that were changed since since_dt are
+# requested from the server-wide worklog feed. The feed covers all users and
+# projects, so this only pays off on small servers, and it misses worklogs
+# that were last changed before since_dt. Raises JIRAError if the server does
+# not support this.
+def index_updated_worklogs(jira, issue_ids, since_dt, author_key, index):
+  # Look up the numeric ids of all issues, which is what worklogs refer to
+  numeric_ids = {}
+  for issue in retry_transient(jira.search_issues, f"issuekey in ({', '.join(map(str, issue_ids))})", fields = "id", maxResults = False):
+    numeric_ids[issue.key] = issue.id
+    numeric_ids[issue.id] = issue.id
+  wanted = {numeric_ids[str(issue_id)]: issue_id for issue_id in issue_ids if str(issue_id) in numeric_ids}
 
-# Does the file exist?
-if not os.path.isfile(args.file):
-  print("ERROR: Spreadsheet file '" + args.file + "' does not exist, aborting.")
-  sys.exit(1)
+  # Page through the ids of all worklogs that were changed since then
+  worklog_ids = []
+  params = {"since": int(since_dt.timestamp() * 1000)}
+  while True:
+    page = retry_transient(jira._session.get, jira._get_url("worklog/updated"), params = params).json()
+    worklog_ids.extend(value["worklogId"] for value in page["values"])
+    if page["lastPage"]:
+      break
+    params = {"since": page["until"]}
+  worklogs = list_worklogs(jira, worklog_ids, wanted)
+  print(f"Loaded worklogs updated since (since_dt={since_dt}): {'.' * len(worklogs)}", flush=True)
 
-# Check if row indexes are valid
-if args.end and args.end < args.start:
-  print("ERROR: Row indexes are messed up, aborting")
-  sys.exit(1)
+  for worklog in worklogs:
+    add_to_index(index, wanted[worklog.issue_id], worklog, author_key)
+
+# Delete a single worklog. If it is gone already, for example because an
+# earlier try was processed but its response got lost, that is fine too.
+def delete_worklog(jira, issue_id, worklog_id):
+  from jira import JIRAError
+  try:
+    retry_transient(jira._session.delete, jira._get_url(f"issue/{issue_id}/worklog/{worklog_id}"))
+  except JIRAError as e:
+    if e.status_code != 404:
+      raise
+    print(f"Warning: Worklog (worklog_id={worklog_id}) for issue (issue_id={issue_id}) does not exist anymore.")
 
 # }}}
-# Main stuff {{{
+# Main function {{{
 #
-# Load data from file
-sheet = pyex.get_sheet(
-  file_name = args.file,
-  sheet_name = args.sheet,
-  start_row = args.start - 1,
-  row_limit = args.end - args.start + 1 if args.end else 0,
-  skip_empty_rows = True,
-)
-if args.debug:
-  print(f"DEBUG: Loaded data from file {args.file}, from sheet {args.sheet}, starting at row {args.start}. Read {sheet.number_of_rows()} rows with {sheet.number_of_columns()} columns from sheet", file=sys.stderr)
-
-# Authenticate to jira
-jira = JIRA(server = args.jira_url, token_auth = args.jira_token)
-jira_user_key = jira.myself()["key"]
-if args.debug:
-  print(f"DEBUG: Authenticated as: jira_user_key={jira_user_key}, {json.dumps(jira.myself(), indent=2, sort_keys=True)}", file=sys.stderr)
-
-# Add worklogs
-if args.command == "create":
-  for row in sheet:
-    # Check for sanity, and extract relevant data from spreadsheet into
-    # variables.
-    if args.debug:
-      print(f"DEBUG: Processing row: {row}", file=sys.stderr)
-    if len(row) < len(fmap):
-      print(f"Warning: Row {row} has {len(row)} fields, but we require at least {len(fmap)}, skipping this row.")
-      continue
-    date = row[fmap["date"]]
-    time_from = row[fmap["time_from"]]
-    time_to = row[fmap["time_to"]]
-    duration = row[fmap["duration"]]
-    issue_id = row[fmap["issue_id"]]
-    description = row[fmap["description"]]
-
-    # Calculate dates and times, do some debug output
-    if args.debug:
-      print(f"DEBUG: parsed from row: date={date}, time_from={time_from}, time_to={time_to}, duration={duration}, issue_id={issue_id}, description={description}", file=sys.stderr)
-    started_dt = datetime(year = date.year, month = date.month, day = date.day, hour = time_from.hour, minute = time_from.minute, second = time_from.second, tzinfo = get_localzone())
-    duration_sec = duration.second + duration.minute * 60 + duration.hour * 3600
-    if args.debug:
-      print(f"DEBUG: calculated dates and durations: started_dt={started_dt}, duration_sec={duration_sec}", file=sys.stderr)
-
-    # Add worklogs to jira (or not, depending on mode)
-    if args.yolo:
-      print(f"Adding worklog (started_dt={started_dt}, duration_sec=@{duration_sec}, description={description[:36]!r}) for issue (issue_id={issue_id})")
-      jira.add_worklog(issue = issue_id, started = started_dt, timeSpentSeconds = duration_sec, comment = description)
-    else:
-      print(f"Would add worklog (started_dt={started_dt}, duration_sec=@{duration_sec}, description={description[:24]!r}) for issue (issue_id={issue_id})")
-
-# Remove worklogs
-elif args.command == "remove":
-  # print(f"The '{args.command}' command is not yet implemented, aborting.")
-  # exit(1)
-
-  # Set up dicts that will be used to cache data for issues and worklogs, then
-  # cycle through all the rows in the sheet.
-  worklogs = {}
-  issues = {}
-  for row in sheet:
-    # Check for sanity, and extract relevant data from spreadsheet into
-    # variables.
-    if args.debug:
-      print(f"DEBUG: Processing row: {row}", file=sys.stderr)
-    if len(row) < len(fmap):
-      print(f"Warning: Row {row} has {len(row)} fields, but we require at least {len(fmap)}, skipping this row.")
-      continue
-    date = row[fmap["date"]]
-    time_from = row[fmap["time_from"]]
-    time_to = row[fmap["time_to"]]
-    duration = row[fmap["duration"]]
-    issue_id = row[fmap["issue_id"]]
-    description = row[fmap["description"]]
-
-    # Calculate dates and times
-    started_dt = datetime(year = date.year, month = date.month, day = date.day, hour = time_from.hour, minute = time_from.minute, second = time_from.second, tzinfo = get_localzone())
-    duration_sec = duration.second + duration.minute * 60 + duration.hour * 3600
-    if args.debug:
-      print(f"DEBUG: calculated dates and durations: started_dt={started_dt}, duration_sec={duration_sec}", file=sys.stderr)
-
-    # Have we seen this issue yet? If not, add it to "issues" dict, retrieve a
-    # list of all worklogs that are associated to it, then retrieve data for
-    # all these worklogs into the "worklogs" dict
-    if not issue_id in issues:
-      issues[issue_id] = jira.worklogs(issue_id)
-      print(f"Loading worklogs for issue (issue_id={issue_id}): ", end="", flush=True)
-      if args.debug:
-        print(f"DEBUG: These are all worklogs for issue_id={issue_id}: {issues[issue_id]}", file=sys.stderr)
-
-      # Retrieve all worklogs for this issue, store into "worklogs" dict
-      for worklog_id in issues[issue_id]:
-        print(f".", end="", flush=True)
-        worklogs[worklog_id] = jira.worklog(issue=issue_id, id=worklog_id)
-        if args.debug:
-          print(f"DEBUG: This is worklog {worklog_id} for issue {issue_id}: {json.dumps(worklogs[worklog_id].raw, indent=2, sort_keys=True)}", file=sys.stderr)
-      print()
-
-    # Figure out what is the correct worklog_id for the worklog that this row
-    # describes.
-    for worklog in worklogs:
-      worklog_author_key = worklog.raw["author"]["key"]
-      worklog_started_dt = datetime.strptime(worklog.raw["started"], "%Y-%m-%dT%H:%M:%S.000%z")
-      worklog_duration_sec = int(worklog.raw["timeSpentSeconds"])
-      worklog_id = worklog.raw["id"]
-      if args.debug:
-        print(f"DEBUG: checking if worklog (worklog_id={worklog_id}, worklog_author_key={worklog_author_key}, worklog_started_dt={worklog_started_dt}, worklog_duration_sec={worklog_duration_sec}) matches with worklog (started_dt={started_dt}, duration_sec={duration_sec}). ", file=sys.stderr, end="")
-      if worklog_author_key == jira_user_key and worklog_started_dt == started_dt and worklog_duration_sec == duration_sec:
-        if args.debug:
-          print(f"YES!", file=sys.stderr)
+def main():
+  # Parse the command-line arguments {{{
+  #
+  # Create a parser, add all the available arguments to it
+  parser = argparse.ArgumentParser(prog="lt2j", description="Read a spreadsheet containing worklog entries, and add them to Jira.")
+  parser.add_argument("-d", "--debug", action="store_true", help="Run in debug mode.")
+  parser.add_argument("-y", "--yolo", "--yes", action="store_true", help="Yes, really do create worklog entries in jira.")
+  parser.add_argument("-f", "--file", required=True, help="Path to the file with the spreadsheet")
+  parser.add_argument("-n", "--sheet", required=True, help="Name of the sheet (tab) where worklog entries are stored.")
+  parser.add_argument("-s", "--start", type=int, default=1, help="Start importing frow this row number.")
+  parser.add_argument("-e", "--end", type=int, default=0, help="End importing at this row number.")
+  parser.add_argument("-u", "--jira-url", required=True, help="The URL where Jira is hosted at.",)
+  parser.add_argument("-t", "--jira-token", required=True, help="The private token for Jira")
+  parser.add_argument("-c", "--concurrency", type=int, default=concurrency, help="How many requests to send to Jira at the same time.")
+  parser.add_argument("--worklog-feed", action="store_true", help="Find worklogs to remove through Jira's server-wide feed of updated worklogs, instead of loading the worklogs of every issue. Only worth it on small servers, and misses worklogs that were last changed over a day before the earliest row.")
+  parser.add_argument("--no-cache", action="store_true", help="Do not use the cache of worklogs from previous runs.")
+  parser.add_argument("command", choices=["create", "remove"], default="create", help="Create or remove worklogs from Jira")
+  args = parser.parse_args()
+
+  # Debug output goes to stderr, and is only formatted when it is enabled. The
+  # log level can also be set with the LOGLEVEL environment variable.
+  logging.basicConfig(format="%(levelname)s: %(message)s", stream=sys.stderr)
+  log_level = os.environ.get("LOGLEVEL", "INFO").upper()
+  if log_level not in logging.getLevelNamesMapping():
+    log.warning("Unknown log level LOGLEVEL=%s, using INFO instead.", log_level)
+    log_level = "INFO"
+  log.setLevel(logging.DEBUG if args.debug else log_level)
+
+  # Write the output in batches of rows, instead of line by line, unless it
+  # needs to stay in step with the debug output
+  if not args.debug:
+    sys.stdout.reconfigure(line_buffering = False)
+
+  # }}}
+  # Do some sanity checking{{{
+  #
+  # Check for common errors in the configuration that we've got
+  if not args.yolo:
+    print("The yolo mode is *NOT* on! Not doing anything, just reporting what would have been done.")
+
+  # Does the file exist?
+  if not os.path.isfile(args.file):
+    print("ERROR: Spreadsheet file '" + args.file + "' does not exist, aborting.")
+    return 1
+
+  # Check if we are allowed to send anything at all
+  if args.concurrency < 1:
+    print("ERROR: Concurrency must be at least 1, aborting.")
+    return 1
+
+  # Check if row indexes are valid
+  if args.end and args.end < args.start:
+    print("ERROR: Row indexes are messed up, aborting")
+    return 1
+
+  # }}}
+  # Main stuff {{{
+  #
+  # Everything is in order, load the modules that do the actual work
+  from jira import JIRA, JIRAError
+  from requests.adapters import HTTPAdapter
+  from tzlocal import get_localzone
+
+  # Open the file for reading, rows are read from it one at a time while they
+  # are being processed, and the file is released once all rows are read
+  rows = read_rows(args.file, args.sheet, args.start, args.end)
+  row_count = 0
+  log.debug("Reading data from file %s, from sheet %s, starting at row %d", args.file, args.sheet, args.start)
+
+  # The timezone that all times in the spreadsheet are in, looked up only once
+  local_tz = get_localzone()
+
+  # Authenticate to jira
+  jira = JIRA(server = args.jira_url, token_auth = args.jira_token, max_retries = 0)
+
+  # Keep a connection open for every worker that talks to jira at the same
+  # time, so connections are reused instead of being set up over and over
+  adapter = HTTPAdapter(pool_maxsize = args.concurrency)
+  jira._session.mount("https://", adapter)
+  jira._session.mount("http://", adapter)
+
+  myself = retry_transient(jira.myself)
+  jira_user_key = myself["key"]
+  log.debug("Authenticated as: jira_user_key=%s, %s", jira_user_key, DebugJSON(myself))
+
+  # Count the worklogs that could not be added
+  failed = 0
+
+  # Open the cache of worklogs from previous runs, it is closed again once the
+  # command is done, even if it fails
+  if not args.no_cache:
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+  with nullcontext() if args.no_cache else shelve.open(cache_file) as cache:
+    # Add worklogs
+    if args.command == "create":
+      # Worklogs to add, grouped by issue so that each issue's worklogs can be
+      # added in sequence, while different issues are processed in parallel.
+      # Worklogs that already exist are indexed the same way as for removal,
+      # so that running the same sheet again does not add them twice.
+      chains = {}
+      issues = set()
+      existing = {}
+      seen = set()
+      for row in rows:
+        row_count += 1
+        if row_count % output_batch == 0:
+          sys.stdout.flush()
+        entry = parse_row(row, local_tz)
+        if entry is None:
+          continue
+        issue_id, started_dt, duration_sec, description = entry.issue_id, entry.started_dt, entry.duration_sec, entry.description
+
+        # Skip worklogs that are already in jira, or earlier in the sheet
+        if not issue_id in issues:
+          issues.add(issue_id)
+          index_worklogs(jira, cache, issue_id, jira_user_key, existing)
+        key = (issue_id, started_dt, duration_sec)
+        if key in seen:
+          print(f"Skipping duplicate row (started_dt={started_dt}, duration_sec=@{duration_sec}) for issue (issue_id={issue_id})")
+          continue
+        seen.add(key)
+        if key in existing:
+          print(f"Skipping existing worklog (started_dt={started_dt}, duration_sec=@{duration_sec}) for issue (issue_id={issue_id})")
+          continue
+
+        # Add worklogs to jira (or not, depending on mode)
         if args.yolo:
-          print(f"Deleting worklog (worklog_id={worklog_id}) for issue (issue_id={issue_id})")
-          worklog.delete()
+          chains.setdefault(issue_id, []).append((started_dt, duration_sec, description))
+        else:
+          print(f"Would add worklog (started_dt={started_dt}, duration_sec=@{duration_sec}, description={description[:24]!r}) for issue (issue_id={issue_id})")
+
+      # Send the collected worklogs to jira, one chain per issue at a time
+      sys.stdout.flush()
+      with ThreadPoolExecutor(max_workers = args.concurrency) as executor:
+        futures = []
+        for issue_id, chain in chains.items():
+          invalidate_worklogs(jira, cache, issue_id)
+          futures.append(executor.submit(add_worklogs, jira, issue_id, chain))
+        failed = sum(future.result() for future in futures)
+      sys.stdout.flush()
+      if failed:
+        print(f"ERROR: Failed to add {failed} worklogs.")
+
+    # Remove worklogs
+    elif args.command == "remove":
+      # print(f"The '{args.command}' command is not yet implemented, aborting.")
+      # exit(1)
+
+      # Read all the rows in the sheet first, so that we know which issues and
+      # which period of time we need to look at
+      entries = []
+      for row in rows:
+        row_count += 1
+        entry = parse_row(row, local_tz)
+        if entry is not None:
+          entries.append(entry)
+
+      # Set up an index of our own worklogs on these issues, keyed by (issue_id,
+      # started_dt, duration_sec). If asked to, ask jira only for worklogs that
+      # changed since a day before the earliest row, otherwise (or if the server
+      # can't do that) load all worklogs of every issue.
+      match_index = {}
+      issue_ids = list(dict.fromkeys(entry.issue_id for entry in entries))
+      use_feed = args.worklog_feed and entries
+      if use_feed:
+        since_dt = min(entry.started_dt for entry in entries) - timedelta(days = 1)
+        try:
+          index_updated_worklogs(jira, issue_ids, since_dt, jira_user_key, match_index)
+        except JIRAError as e:
+          if e.status_code not in (400, 404, 405):
+            raise
+          print(f"Warning: Could not load updated worklogs, loading worklogs per issue instead: {e}")
+          match_index = {}
+          use_feed = False
+      if not use_feed:
+        for issue_id in issue_ids:
+          index_worklogs(jira, cache, issue_id, jira_user_key, match_index)
+
+      # Cycle through all the rows in the sheet
+      for n, entry in enumerate(entries, 1):
+        if n % output_batch == 0:
+          sys.stdout.flush()
+        issue_id, started_dt, duration_sec = entry.issue_id, entry.started_dt, entry.duration_sec
+
+        # Figure out what is the correct worklog_id for the worklog that this row
+        # describes. Each row removes at most one worklog.
+        worklog_ids = match_index.get((issue_id, started_dt, duration_sec))
+        if not worklog_ids:
+          log.debug("No worklog matches with worklog (started_dt=%s, duration_sec=%d) for issue (issue_id=%s)", started_dt, duration_sec, issue_id)
+          continue
+        worklog_id = worklog_ids.pop(0)
+        if args.yolo:
+          print(f"Deleting worklog (worklog_id={worklog_id}) for issue (issue_id={issue_id})", flush=True)
+          delete_worklog(jira, issue_id, worklog_id)
+          invalidate_worklogs(jira, cache, issue_id)
         else:
           print(f"Would delete worklog (worklog_id={worklog_id}) for issue (issue_id={issue_id})", file=sys.stderr)
-        continue
-      else:
-        if args.debug:
-          print(f"No.", file=sys.stderr)
 
-# Unknown action
-else:
-  print(f"Unknown command {args.command}, aborting.")
-  sys.exit(1)
+    # Unknown action
+    else:
+      print(f"Unknown command {args.command}, aborting.")
+      return 1
+
+  log.debug("Read %d rows from file %s, from sheet %s", row_count, args.file, args.sheet)
+
+  return 1 if failed else 0
 
 # }}}
 
+if __name__ == "__main__":
+  sys.exit(main())
+
 # vim: set ts=2 sw=2 sts=2 et cc=80 fdl=0 fdm=marker: